@@ -144,7 +144,8 @@ def get_contours(cont_img, rgb_image_shape):
         - contours: List of valid regions (coordinates);
         - mask: binary mask array;
 
-        !!! It should be noticed that the shape of mask array is: (HEIGHT, WIDTH, CHANNEL).
+        !!! It should be noticed that the shape of mask array is: (HEIGHT, WIDTH).
+        The mask is binary, so one channel is enough.
     '''
     
     verboseprint('contour image: ',cont_img.shape)
@@ -161,8 +162,7 @@ def get_contours(cont_img, rgb_image_shape):
     mask = np.zeros(rgb_image_shape, np.uint8)
     
     verboseprint('mask shape', mask.shape)
-    cv2.drawContours(mask, contours, -1, \
-                    (PIXEL_WHITE, PIXEL_WHITE, PIXEL_WHITE),thickness=-1)
+    cv2.drawContours(mask, contours, -1, PIXEL_WHITE, thickness=-1)
     
     return boundingBoxes, contour_coords, contours, mask
 
@@ -185,7 +185,7 @@ def segmentation_hsv(wsi_hsv_, wsi_rgb_):
         - mask: binary mask array;
 
         !!! It should be noticed that:
-        1. The shape of mask array is: (HEIGHT, WIDTH, CHANNEL);
+        1. The shape of mask array is: (HEIGHT, WIDTH);
         2. $contours is unprocessed format of contour list returned by OpenCV cv2.findContours method.
         
         The shape of arrays in $contours is: (NUMBER_OF_COORDS, 1, 2), 2 stands for x, y;
@@ -234,7 +234,7 @@ def segmentation_hsv(wsi_hsv_, wsi_rgb_):
 
     verboseprint("Getting Contour: ")
     bounding_boxes, contour_coords, contours, mask \
-    = get_contours(np.array(image_open), wsi_rgb_.shape)
+    = get_contours(np.array(image_open), wsi_rgb_.shape[:2])
       
     return bounding_boxes, contour_coords, contours, mask
 
@@ -311,7 +311,7 @@ def construct_bags(wsi_, wsi_rgb, contours, mask, level, mag_factor, PATCH_SIZE)
                 '''
                     !!! Take care of difference in shapes
                     Here, the shape of wsi_rgb is (HEIGHT, WIDTH, CHANNEL)
-                    the shape of mask is (HEIGHT, WIDTH, CHANNEL)
+                    the shape of mask is (HEIGHT, WIDTH)
                 '''
                 patch_arr = wsi_rgb[y_height_: y_height_ + PATCH_SIZE,\
                                     x_width_:x_width_ + PATCH_SIZE,:]            
@@ -326,41 +326,24 @@ def construct_bags(wsi_, wsi_rgb, contours, mask, level, mag_factor, PATCH_SIZE)
                 verboseprint("Numpy mask shape: ", patch_mask_arr.shape)
                 verboseprint("Numpy patch shape: ", patch_arr.shape)
 
-                try:
-                    bitwise_ = cv2.bitwise_and(patch_arr, patch_mask_arr)
-                
-                except Exception as err:
-                    print('Out of the boundary')
-                    pass
-                    
-#                     f_ = ((patch_arr > PIXEL_TH) * 1)
-#                     f_ = (f_ * PIXEL_WHITE).astype('uint8')
+                # The mask is single-channel, so valid pixels are counted directly.
+                white_pixel_cnt = cv2.countNonZero(patch_mask_arr)
+
+                '''
+                    Patches whose valid area >= 25% of total area is considered
+                    valid and selected.
+                '''
 
-#                     if np.mean(f_) <= (PIXEL_TH + 40):
-#                         patches.append(patch_arr)
-#                         patches_coords.append((x_width_, y_height_))
-#                         print(x_width_, y_height_)
-#                         print('Saved\n')
+                if white_pixel_cnt >= ((PATCH_SIZE ** 2) * 0.25):
+                    
+                    if patch_arr.shape == (PATCH_SIZE, PATCH_SIZE, CHANNEL):
+                        patches.append(patch_arr)
+                        patches_coords.append((x_width_, y_height_))
+                        verboseprint(x_width_, y_height_)
+                        verboseprint('Saved\n')
 
                 else:
-                    bitwise_grey = cv2.cvtColor(bitwise_, cv2.COLOR_RGB2GRAY)
-                    white_pixel_cnt = cv2.countNonZero(bitwise_grey)
-
-                    '''
-                        Patches whose valid area >= 25% of total area is considered
-                        valid and selected.
-                    '''
-
-                    if white_pixel_cnt >= ((PATCH_SIZE ** 2) * 0.25):
-                        
-                        if patch_arr.shape == (PATCH_SIZE, PATCH_SIZE, CHANNEL):
-                            patches.append(patch_arr)
-                            patches_coords.append((x_width_, y_height_))
-                            verboseprint(x_width_, y_height_)
-                            verboseprint('Saved\n')
-
-                    else:
-                        verboseprint('Did not save\n')
+                    verboseprint('Did not save\n')
 
     end = time.time()
     verboseprint("Time spent on patch extraction: ",  (end - start))
@@ -4,10 +4,15 @@
 import time
 import random
 import os
+import multiprocessing
 import cv2
 import numpy as np
 import pandas as pd
-import gc
+import logging
+import ctypes
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 from openslide import OpenSlide, OpenSlideUnsupportedFormatError
@@ -22,6 +27,43 @@ from ast import literal_eval
 
 import pickle
 
+try:
+    from numba import njit, prange
+except ImportError:
+    '''
+        numba is optional. Without it, the functions decorated by njit below 
+        are run as plain Python functions.
+    '''
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    '''
+        pyvips is optional. Without it (or without libvips), tiles are read 
+        with OpenSlide read_region().
+    '''
+    pyvips = None
+
+try:
+    LIBC = ctypes.CDLL('libc.so.6')
+except OSError:
+    '''
+        Not glibc, memory freed is simply kept by the allocator.
+    '''
+    LIBC = None
+
+'''
+    Messages printed for every tile / patch are logged at DEBUG level, so they 
+    cost nothing unless DEBUG is enabled. Progress of sections is still printed.
+'''
+logger = logging.getLogger(__name__)
+
 '''
     Global variables / constants
 '''
@@ -43,6 +85,37 @@ PIXEL_BLACK = 0
 '''
 SPLIT = 4
 
+'''
+    Each section is further read and processed tile by tile, so only one
+    TILE x TILE region (plus a small halo) is held in memory at a time.
+'''
+TILE = 4096
+
+'''
+    The segmentation (thresholding and morphology) is performed on images
+    downsampled by MASK_DOWNSAMPLE, and the resulting mask is scaled back.
+'''
+MASK_DOWNSAMPLE = 4
+
+'''
+    Tiles are segmented with a halo of SEG_HALO on each side, so the morphology
+    near the tile borders sees the same pixels as in the whole section.
+'''
+SEG_HALO = 16 * MASK_DOWNSAMPLE
+
+'''
+    Number of threads encoding JPEG images in save_to_disk(). Workers of 
+    extract_all() lower it, see init_worker().
+'''
+JPEG_THREADS = os.cpu_count()
+
+'''
+    Whether the segmentation runs on GPU through cv2.cuda. It is checked on the 
+    first call of segmentation_hsv() in each process, because a CUDA context 
+    created before multiprocessing.Pool forks could not be used by the workers.
+'''
+USE_CUDA = None
+
 level = 1
 mag_factor = pow(2, level)
 
@@ -83,16 +156,59 @@ def openSlide_init(tif_file_path, level):
         return wsi_obj
 
 '''
-    Load selected parts of the slides into memory.
+    Return memory freed by the last section to the OS.
 '''
-def read_wsi(wsi_obj, level, mag_factor, sect):
-    
+def release_memory():
     '''
-        Identify and load slides.
+        NumPy arrays are freed as soon as their last reference is deleted, so 
+        no gc.collect() is needed. glibc may still keep the freed pages in its 
+        arenas, and malloc_trim(0) gives them back, which is much cheaper than 
+        a full GC pass over the heap.
+    '''
+    if LIBC is not None and hasattr(LIBC, 'malloc_trim'):
+        LIBC.malloc_trim(0)
+
+'''
+    pyvips images opened in this process, keyed by (slide path, level).
+'''
+VIPS_SLIDES = dict()
+
+def vips_init(tif_file_path, level):
+    '''
+        Opens the level of the slide with pyvips, once per process.
+
+        Returns:
+            - vips_obj: pyvips image of the level, or None if pyvips is unavailable
+            or could not open the slide.
+    '''
+    if pyvips is None:
+        return None
+
+    key_ = (tif_file_path, level)
+
+    if key_ not in VIPS_SLIDES:
+        try:
+            VIPS_SLIDES[key_] = pyvips.Image.openslideload(tif_file_path, level=level)
+        except pyvips.Error:
+            logger.debug('pyvips could not open %s, fall back to OpenSlide', \
+                         tif_file_path)
+            VIPS_SLIDES[key_] = None
+
+    return VIPS_SLIDES[key_]
+
+'''
+    Position and size of one section of the WSI, in selected level scale.
+'''
+SectionSpec = namedtuple('SectionSpec', ['sect', 'delta_x', 'delta_y', 'w', 'h'])
+
+def section_spec(wsi_obj, level, sect, split_num=SPLIT):
+
+    '''
+        Computes the position and size of a section once, so that the functions
+        processing the section do not need to recompute them.
         Args:
             wsi_obj: OpenSlide object;
             level: magnification level;
-            mag_factor: pow(2, level);
             sect: string, indicates which part of the WSI. For example:
             sect='12':
              _ _ _ _
@@ -107,9 +223,39 @@ def read_wsi(wsi_obj, level, mag_factor, sect):
             |*|_|_|_|
             |_|_|_|_|
             |_|_|_|_| 
+            split_num: how many parts the WSI is split into, along each axis.
 
         Returns:
-            - rgba_image: WSI image loaded, NumPy array type.
+            - SectionSpec: (sect, delta_x, delta_y, w, h), where (delta_x, delta_y)
+            is the upper-left corner of the section and (w, h) its size.
+    '''
+
+    # level1 dimension
+    width_whole, height_whole = wsi_obj.level_dimensions[level]
+
+    # section size after split
+    width_split, height_split = width_whole // split_num, height_whole // split_num
+
+    delta_x = int(sect[0]) * width_split
+    delta_y = int(sect[1]) * height_split
+
+    return SectionSpec(sect, delta_x, delta_y, width_split, height_split)
+
+'''
+    Load selected parts of the slides into memory.
+'''
+def read_wsi(wsi_obj, level, mag_factor, spec):
+    
+    '''
+        Identify and load slides.
+        Args:
+            wsi_obj: OpenSlide object;
+            level: magnification level;
+            mag_factor: pow(2, level);
+            spec: SectionSpec, indicates which part of the WSI, see section_spec().
+
+        Returns:
+            - rgb_image: WSI image loaded, NumPy array type, (HEIGHT, WIDTH, 3).
     '''
     
     time_s = time.time()
@@ -124,27 +270,15 @@ def read_wsi(wsi_obj, level, mag_factor, sect):
         Load the whole image in level < 3 could cause failures.
     '''
 
-    # Here we load the whole image from (0, 0), so transformation of coordinates 
-    # is not skipped.
-
-    # level1 dimension
-    width_whole, height_whole = wsi_obj.level_dimensions[level]
-    print("level1 dimension (width, height): ", width_whole, height_whole)
-
-    # section size after split
-    width_split, height_split = width_whole // SPLIT, height_whole // SPLIT
-    print("section size (width, height): ", width_split, height_split)
+    print("section size (width, height): ", spec.w, spec.h)
 
     '''
         Be aware that the first arg of read_region is a tuple of coordinates in 
         level0 reference frame.
     '''
-    delta_x = int(sect[0]) * width_split
-    delta_y = int(sect[1]) * height_split
-
-    rgba_image_pil = wsi_obj.read_region((delta_x * mag_factor, \
-                                          delta_y * mag_factor), \
-                                          level, (width_split, height_split))
+    rgba_image_pil = wsi_obj.read_region((spec.delta_x * mag_factor, \
+                                          spec.delta_y * mag_factor), \
+                                          level, (spec.w, spec.h))
 
     print("rgba image dimension (width, height):", rgba_image_pil.size)
 
@@ -158,28 +292,82 @@ def read_wsi(wsi_obj, level, mag_factor, sect):
         (HEIGHT, WIDTH, CHANNEL).
 
         2. The image here is RGBA image, in which A stands for Alpha channel.
-        The A channel is unnecessary for now and could be dropped.
+        The A channel is unnecessary and is dropped by Pillow before the 
+        conversion, so it is never copied into the NumPy array.
+
+        3. np.frombuffer() on the raw bytes is a single memcpy, which is much
+        cheaper than np.asarray() on the Pillow Image object.
     '''
-    rgba_image = np.asarray(rgba_image_pil)
-    print("transformed:", rgba_image.shape)
+    width_pil, height_pil = rgba_image_pil.size
+    rgb_image_pil = rgba_image_pil.convert('RGB')
+    del rgba_image_pil
+
+    rgb_image = np.frombuffer(rgb_image_pil.tobytes(), dtype=np.uint8)\
+                .reshape(height_pil, width_pil, 3)
+    del rgb_image_pil
+    print("transformed:", rgb_image.shape)
 
     time_e = time.time()
     
     print("Time spent on loading WSI section into memory: ", (time_e - time_s))
     
-    return rgba_image
+    return rgb_image
+
+'''
+    Load one tile of a section into memory.
+'''
+def read_tile(wsi_obj, level, mag_factor, x, y, width, height, vips_obj=None):
+
+    '''
+        Args:
+            - wsi_obj: OpenSlide object;
+            - level: magnification level;
+            - mag_factor: pow(2, level);
+            - x, y: upper-left corner of the tile, in selected level scale;
+            - width, height: size of the tile, in selected level scale;
+            - vips_obj: pyvips image of the level, see vips_init(). If given, 
+            the tile is read with pyvips instead of OpenSlide.
+
+        Returns:
+            - rgb_tile: tile loaded, NumPy array type, (HEIGHT, WIDTH, 3).
+
+        !!! pyvips reads the level image directly, so $x, $y are not scaled by 
+        $mag_factor there, and no PIL image is created.
+    '''
+
+    if vips_obj is not None:
+        region_ = vips_obj.extract_area(x, y, width, height).extract_band(0, n=3)
+
+        return np.frombuffer(region_.write_to_memory(), dtype=np.uint8)\
+               .reshape(height, width, 3)
+
+    # The first arg of read_region is in level0 reference frame.
+    rgba_tile_pil = wsi_obj.read_region((x * mag_factor, y * mag_factor), \
+                                        level, (width, height))
+
+    # Drop the A channel before converting to NumPy array, see read_wsi().
+    rgb_tile_pil = rgba_tile_pil.convert('RGB')
+    del rgba_tile_pil
+
+    rgb_tile = np.frombuffer(rgb_tile_pil.tobytes(), dtype=np.uint8)\
+               .reshape(height, width, 3)
+    del rgb_tile_pil
+
+    return rgb_tile
 
 '''
-    Convert RGBA to RGB, HSV and GRAY.
+    Convert RGB to HSV and GRAY.
 '''
-def construct_colored_wsi(rgba_):
+def construct_colored_wsi(rgb_):
 
     '''
-        This function splits and merges R, G, B channels.
-        HSV and GRAY images are also created for future segmentation procedure.
+        HSV and GRAY images are created for future segmentation procedure.
+
+        read_wsi() already drops the Alpha channel. If $rgb_ still has one 
+        (RGBA images loaded elsewhere), it is dropped here.
 
         Args:
-            - rgba_: Image to be processed, NumPy array type.
+            - rgb_: Image to be processed, NumPy array type.
 
         Returns:
             - wsi_rgb_: RGB image, NumPy array type.
@@ -187,79 +375,199 @@ def construct_colored_wsi(rgba_):
             - wsi_hsv_: HSV image, NumPy array type.
 
     '''
-    r_, g_, b_, a_ = cv2.split(rgba_)
-    
-    wsi_rgb_ = cv2.merge((r_, g_, b_))
+    if rgb_.shape[2] == 3:
+        wsi_rgb_ = rgb_
+    else:
+        # Slicing off the A channel copies the section only once, instead of
+        # splitting it into planes and merging them back again.
+        wsi_rgb_ = np.ascontiguousarray(rgb_[:, :, :3])
+
     wsi_gray_ = cv2.cvtColor(wsi_rgb_,cv2.COLOR_RGB2GRAY)
     wsi_hsv_ = cv2.cvtColor(wsi_rgb_, cv2.COLOR_RGB2HSV)
     
     return wsi_rgb_, wsi_gray_, wsi_hsv_
 
 '''
+    Get valid regions from the segmentation result.
 '''
-def get_contours(cont_img, rgb_image_shape):
+def get_contours(cont_img):
     
     '''
     Args:
-        - cont_img: images with contours, these images are in np.array format.
-        - rgb_image_shape: shape of rgb image, (HEIGHT, WIDTH).
+        - cont_img: binary image of valid regions, in np.array format.
 
     Returns: 
-        - bounding_boxs: List of regions, region: (x, y, w, h);
-        - contour_coords: List of valid region coordinates (contours squeezed);
-        - contours: List of valid regions (coordinates);
+        - bounding_boxes: array of regions, region: (x, y, w, h), sorted by their 
+        areas in descending order;
         - mask: binary mask array;
 
-        !!! It should be noticed that the shape of mask array is: (HEIGHT, WIDTH, CHANNEL).
+        !!! It should be noticed that the shape of mask array is: (HEIGHT, WIDTH).
+
+        cv2.connectedComponentsWithStats gives the bounding boxes and areas of all 
+        regions in one pass, so there is no need to trace the contours.
+
+        Holes inside the regions are filled first, like the outer contours drawn 
+        with thickness=-1 did before, so that the mask and the areas used to rank 
+        the regions are not changed by lumens or fat inside the tissue.
     '''
     
-    print('contour image dimension: ',cont_img.shape)
-    
-    contour_coords = []
-    _, contours, _ = cv2.findContours(cont_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    logger.debug('contour image dimension: %s', cont_img.shape)
 
-    boundingBoxes = [cv2.boundingRect(c) for c in contours]
+    height_, width_ = cont_img.shape[:2]
 
-    for contour in contours:
-        contour_coords.append(np.squeeze(contour))
-        
-    mask = np.zeros(rgb_image_shape, np.uint8)
+    '''
+        Background components not touching the image border are holes. 4-connectivity
+        is used for the background, as 8-connectivity is used for the regions.
+    '''
+    holes_num, holes, stats, _ \
+    = cv2.connectedComponentsWithStats((cont_img == 0).astype(np.uint8), \
+                                       connectivity=4)
+
+    left_, top_ = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    right_ = left_ + stats[:, cv2.CC_STAT_WIDTH]
+    bottom_ = top_ + stats[:, cv2.CC_STAT_HEIGHT]
+
+    is_hole = (left_ > 0) & (top_ > 0) & (right_ < width_) & (bottom_ < height_)
+    # label 0 stands for the regions here.
+    is_hole[0] = False
+
+    filled_ = ((cont_img > 0) | is_hole[holes]).astype(np.uint8)
+    del holes
+
+    regions_num, labels, stats, _ = cv2.connectedComponentsWithStats(filled_, \
+                                                                     connectivity=8)
+    del filled_
+
+    # label 0 stands for the background.
+    stats = stats[1:]
+    order = np.argsort(-stats[:, cv2.CC_STAT_AREA], kind='stable')
+
+    # columns: CC_STAT_LEFT, CC_STAT_TOP, CC_STAT_WIDTH, CC_STAT_HEIGHT
+    bounding_boxes = stats[order, :4]
+
+    # The mask is binary, so one channel is enough.
+    mask = (labels != 0).astype(np.uint8) * PIXEL_WHITE
     
-    print('mask image dimension: ', mask.shape)
-    cv2.drawContours(mask, contours, -1, \
-                    (PIXEL_WHITE, PIXEL_WHITE, PIXEL_WHITE),thickness=-1)
+    logger.debug('mask image dimension: %s', mask.shape)
     
-    return boundingBoxes, contour_coords, contours, mask
+    return bounding_boxes, mask
+
+'''
+    Check whether OpenCV is built with CUDA and a CUDA device is present.
+'''
+def cuda_available():
+    global USE_CUDA
+
+    if USE_CUDA is None:
+        try:
+            USE_CUDA = cv2.cuda.getCudaEnabledDeviceCount() > 0
+        except (AttributeError, cv2.error):
+            USE_CUDA = False
+
+    return USE_CUDA
+
+'''
+    Perform thresholding and morphology of segmentation_hsv() on GPU.
+'''
+def segmentation_mask_cuda(wsi_rgb_, lower_, upper_, close_kernel, open_kernel):
+    '''
+    Args:
+        - wsi_rgb_: RGB images.
+        - lower_, upper_: thresholds for H, S, V values.
+        - close_kernel, open_kernel: structuring elements of closing and openning.
+
+    Returns:
+        - image_open: binary image downsampled by MASK_DOWNSAMPLE, in np.array format.
+
+        The image is uploaded once, and all steps run on device before it is 
+        downloaded. OpenCV has no cv2.cuda.morphologyEx, so morphology filters 
+        created by cv2.cuda.createMorphologyFilter are used instead.
+    '''
+    height_, width_ = wsi_rgb_.shape[:2]
+
+    gpu_ = cv2.cuda_GpuMat()
+    gpu_.upload(np.ascontiguousarray(wsi_rgb_))
+
+    # segmentation_mask() pads the image to multiples of MASK_DOWNSAMPLE.
+    gpu_ = cv2.cuda.resize(gpu_, (width_ // MASK_DOWNSAMPLE, \
+                                  height_ // MASK_DOWNSAMPLE), \
+                           interpolation=cv2.INTER_AREA)
+    gpu_ = cv2.cuda.cvtColor(gpu_, cv2.COLOR_RGB2HSV)
+    gpu_ = cv2.cuda.inRange(gpu_, tuple(int(v) for v in lower_), \
+                            tuple(int(v) for v in upper_))
+
+    close_filter = cv2.cuda.createMorphologyFilter(cv2.MORPH_CLOSE, cv2.CV_8UC1, \
+                                                   close_kernel)
+    open_filter = cv2.cuda.createMorphologyFilter(cv2.MORPH_OPEN, cv2.CV_8UC1, \
+                                                  open_kernel)
+    gpu_ = open_filter.apply(close_filter.apply(gpu_))
+
+    return gpu_.download()
 
 '''
-    Perform segmentation and get contours.
+    Perform segmentation and get valid regions.
 '''
-def segmentation_hsv(wsi_hsv_, wsi_rgb_):
+def segmentation_hsv(wsi_rgb_):
     '''
-    This func is designed to remove background of WSIs. 
+    This func is designed to remove background of WSIs.
 
     Args:
-        - wsi_hsv_: HSV images.
         - wsi_rgb_: RGB images.
 
     Returns: 
-        - bounding_boxs: List of regions, region: (x, y, w, h);
-        - contour_coords: List of arrays. Each array stands for a valid region and 
-        contains contour coordinates of that region.
-        - contours: Almost same to $contour_coords;
+        - bounding_boxes: array of regions, region: (x, y, w, h), sorted by their 
+        areas in descending order, see get_contours();
         - mask: binary mask array;
 
-        !!! It should be noticed that:
-        1. The shape of mask array is: (HEIGHT, WIDTH, CHANNEL);
-        2. $contours is unprocessed format of contour list returned by OpenCV cv2.findContours method.
-        
-        The shape of arrays in $contours is: (NUMBER_OF_COORDS, 1, 2), 2 stands for x, y;
-        The shape of arrays in $contour_coords is: (NUMBER_OF_COORDS, 2), 2 stands for x, y;
+        !!! It should be noticed that the shape of mask array is: (HEIGHT, WIDTH).
+    '''
+    # print("Getting Contour: ")
+    bounding_boxes, mask = get_contours(segmentation_mask(wsi_rgb_))
+      
+    return bounding_boxes, mask
 
-        The only difference between $contours and $contour_coords is in shape.
+'''
+    Size of a morphology kernel on the downsampled image.
+'''
+def morph_size(full_size):
+    '''
+        Args:
+            - full_size: size of the kernel at full resolution.
+
+        Returns:
+            - odd size, >= 3, of the kernel used on images downsampled by MASK_DOWNSAMPLE.
     '''
-    print("HSV segmentation step")
-    contour_coord = []
+    return max(3, int(round(full_size / MASK_DOWNSAMPLE)) | 1)
+
+'''
+    Threshold and clean the HSV image, see segmentation_hsv().
+'''
+def segmentation_mask(wsi_rgb_, downsampled=False):
+    '''
+    extract_section() stitches the downsampled results of its tiles first, and gets
+    the regions of the whole section afterwards.
+
+    The HSV image is computed on a copy of $wsi_rgb_ downsampled by MASK_DOWNSAMPLE,
+    which reduces the work of thresholding and morphology by MASK_DOWNSAMPLE ** 2.
+    When a CUDA device is available, these steps run on GPU instead, see 
+    segmentation_mask_cuda().
+    The mask is scaled back to the size of $wsi_rgb_, so the coordinates are 
+    still in selected level scale, unless $downsampled is True.
+
+    Args:
+        - wsi_rgb_: RGB images.
+        - downsampled: if True, the mask is returned at its downsampled size.
+
+    Returns: 
+        - image_open: binary image (0 / PIXEL_WHITE) of the valid regions, holes 
+        are not filled yet, (HEIGHT, WIDTH), or
+        (ceil(HEIGHT / MASK_DOWNSAMPLE), ceil(WIDTH / MASK_DOWNSAMPLE)) if $downsampled.
+
+        !!! Pixel (i, j) of the downsampled mask stands for the block 
+        [i * MASK_DOWNSAMPLE, (i + 1) * MASK_DOWNSAMPLE) x [j * MASK_DOWNSAMPLE, ...)
+        of $wsi_rgb_, see upsample_mask().
+    '''
+    logger.debug("HSV segmentation step")
     
     '''
         Here we could tune for better results.
@@ -273,74 +581,185 @@ def segmentation_hsv(wsi_hsv_, wsi_rgb_):
     lower_ = np.array([20,20,20])
     upper_ = np.array([200,200,200]) 
 
-    # HSV image threshold
-    thresh = cv2.inRange(wsi_hsv_, lower_, upper_)
-    
+    height_, width_ = wsi_rgb_.shape[:2]
+
+    # The image is padded to multiples of MASK_DOWNSAMPLE, so each pixel of the 
+    # downsampled mask covers exactly one block of the image.
+    pad_h = -height_ % MASK_DOWNSAMPLE
+    pad_w = -width_ % MASK_DOWNSAMPLE
+
+    if pad_h or pad_w:
+        wsi_rgb_ = cv2.copyMakeBorder(wsi_rgb_, 0, pad_h, 0, pad_w, cv2.BORDER_REPLICATE)
+
     '''
-        Closing Step
+        The kernels of 15 x 15 (closing) and 5 x 5 (openning) are meant for the
+        full resolution, so their sizes are divided by MASK_DOWNSAMPLE.
+
+        !!! The sizes are kept odd and at least 3: OpenCV anchors even kernels
+        off-centre, which would shift the mask down-right at every step, and a 
+        1 x 1 kernel makes the step do nothing.
     '''
-    # print("Closing step: ")
-    close_kernel = np.ones((15, 15), dtype=np.uint8) 
-    image_close = cv2.morphologyEx(np.array(thresh),cv2.MORPH_CLOSE, close_kernel)
-    # print("image_close size", image_close.shape)
+    close_size = morph_size(15)
+    close_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (close_size, close_size))
+    open_size = morph_size(5)
+    open_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (open_size, open_size))
+
+    if cuda_available():
+        image_open = segmentation_mask_cuda(wsi_rgb_, lower_, upper_, \
+                                            close_kernel, open_kernel)
+    else:
+        # dsize is given explicitly, as fx / fy would round a side of 1 or 2 
+        # pixels down to 0.
+        wsi_small_ = cv2.resize(wsi_rgb_, ((width_ + pad_w) // MASK_DOWNSAMPLE, \
+                                           (height_ + pad_h) // MASK_DOWNSAMPLE), \
+                                interpolation=cv2.INTER_AREA)
+        wsi_hsv_ = cv2.cvtColor(wsi_small_, cv2.COLOR_RGB2HSV)
+        del wsi_small_
+
+        # HSV image threshold
+        thresh = cv2.inRange(wsi_hsv_, lower_, upper_)
+        del wsi_hsv_
+
+        '''
+            Closing Step
+        '''
+        # print("Closing step: ")
+        image_close = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, close_kernel)
+        # print("image_close size", image_close.shape)
+
+        '''
+            Openning Step
+        ''' 
+        # print("Openning step: ")
+        image_open = cv2.morphologyEx(image_close, cv2.MORPH_OPEN, open_kernel)
+        # print("image_open size", image_open.size)
 
+    if downsampled:
+        return image_open
+
+    return upsample_mask(image_open, 0, 0, width_, height_)
+
+'''
+    Scale part of a downsampled mask back to the full resolution.
+'''
+def upsample_mask(mask_small, x, y, width, height, factor=MASK_DOWNSAMPLE):
     '''
-        Openning Step
-    ''' 
-    # print("Openning step: ")
-    open_kernel = np.ones((5, 5), dtype=np.uint8)
-    image_open = cv2.morphologyEx(image_close, cv2.MORPH_OPEN, open_kernel)
-    # print("image_open size", image_open.size)
+        Args:
+            - mask_small: mask downsampled by $factor, see segmentation_mask();
+            - x, y, width, height: the part wanted, in full resolution;
+            - factor: downsampling factor of $mask_small.
 
-    # print("Getting Contour: ")
-    bounding_boxes, contour_coords, contours, mask \
-    = get_contours(np.array(image_open), wsi_rgb_.shape)
-      
-    return bounding_boxes, contour_coords, contours, mask
+        Returns:
+            - mask: binary mask of the part, (HEIGHT, WIDTH).
+
+        Each pixel is repeated into a $factor x $factor block (which is also what
+        INTER_NEAREST does for an integer factor), so the mask stays binary and 
+        only the part wanted is allocated.
+    '''
+    x_small, y_small = x // factor, y // factor
+
+    sub_ = mask_small[y_small: -(-(y + height) // factor), \
+                      x_small: -(-(x + width) // factor)]
+    sub_ = np.repeat(np.repeat(sub_, factor, axis=0), factor, axis=1)
+
+    return sub_[y - y_small * factor: y - y_small * factor + height, \
+                x - x_small * factor: x - x_small * factor + width]
 
 
 '''
-    Extract patches which are considered valid in the segmentation step. 
+    Compute the valid area of one patch from the integral image of the mask.
 '''
-def construct_bags(wsi_obj, wsi_rgb, contours, mask, level, \
-                   mag_factor, sect, patch_size, split_num):
-    
+@njit(cache=True)
+def valid_area(mask_integral, x, y, patch_size):
+    return mask_integral[y + patch_size, x + patch_size] \
+         - mask_integral[y, x + patch_size] \
+         - mask_integral[y + patch_size, x] \
+         + mask_integral[y, x]
+
+'''
+    Collect the positions of valid patches in the bounding boxes.
+'''
+@njit(parallel=True, cache=True)
+def collect_positions(mask_integral, boxes, patch_size, thresh, x_limit, y_limit):
     '''
     Args:
-        - wsi_obj: 
-        - wsi_rgb:
-        - contours:
-        - mask:
-        - level:
-        - mag_factor:
-        - sect
-        - patch_size:
-        - split_num: 
+        - mask_integral: integral image of the binary (0 / 1) mask, cv2.integral();
+        - boxes: bounding boxes, int array of shape (NUMBER_OF_BOXES, 4): (x, y, w, h);
+        - patch_size: size of patches, which is also the step size of the grid;
+        - thresh: minimal valid area of a patch;
+        - x_limit, y_limit: patches have to start before (x_limit, y_limit).
 
-    Returns: 
-        - patches: lists of patches in numpy array: [PATCH_WIDTH, PATCH_HEIGHT, CHANNEL]
+    Returns:
+        - xs, ys: int32 arrays, coordinates of the valid patches (x_min, y_min).
 
-        - patches_coords: coordinates of patches, (x_min, y_min). 
-        The bouding box of the patch is (x_min, y_min, x_min + PATCH_WIDTH, y_min + PATCH_HEIGHT)
-    
+        !!! The boxes are scanned in parallel twice: the first pass counts the 
+        valid patches of each box, so that the second pass could write the 
+        positions into preallocated arrays, in the same order as a serial scan.
     '''
 
-    patches = list()
-    patches_coords = list()
-    patches_coords_local = list()
+    n_boxes = boxes.shape[0]
+    counts = np.zeros(n_boxes, np.int64)
 
-    start = time.time()
-    
-    # level1 dimension
-    width_whole, height_whole = wsi_obj.level_dimensions[level]
-    width_split, height_split = width_whole // split_num, height_whole // split_num
-    # print(width_whole, height_whole)
+    for i in prange(n_boxes):
+        x_end = min(boxes[i, 0] + boxes[i, 2], x_limit)
+        y_end = min(boxes[i, 1] + boxes[i, 3], y_limit)
 
-    # section size after split
-    # print(int(sect[0]), int(sect[1]))
-    delta_x = int(sect[0]) * width_split
-    delta_y = int(sect[1]) * height_split
-    # print("delta:", delta_x, delta_y)
+        for y in range(boxes[i, 1], y_end, patch_size):
+            for x in range(boxes[i, 0], x_end, patch_size):
+                if valid_area(mask_integral, x, y, patch_size) >= thresh:
+                    counts[i] += 1
+
+    offsets = np.zeros(n_boxes + 1, np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    xs = np.empty(offsets[-1], np.int32)
+    ys = np.empty(offsets[-1], np.int32)
+
+    for i in prange(n_boxes):
+        x_end = min(boxes[i, 0] + boxes[i, 2], x_limit)
+        y_end = min(boxes[i, 1] + boxes[i, 3], y_limit)
+        k = offsets[i]
+
+        for y in range(boxes[i, 1], y_end, patch_size):
+            for x in range(boxes[i, 0], x_end, patch_size):
+                if valid_area(mask_integral, x, y, patch_size) >= thresh:
+                    xs[k] = x
+                    ys[k] = y
+                    k += 1
+
+    return xs, ys
+
+'''
+    Locate patches which are considered valid in the segmentation step. 
+'''
+def patch_positions(bounding_boxes, mask, patch_size, \
+                    tile_origin=(0, 0), tile_core=None):
+
+    '''
+    Args:
+        - bounding_boxes: regions of the whole section, sorted by areas, see get_contours();
+        - mask: binary mask starting at $tile_origin, (HEIGHT, WIDTH). It has to 
+        cover the patches starting in the tile, i.e. (tile_core + patch_size - 1)
+        where the section allows;
+        - patch_size:
+        - tile_origin: (x, y) of the tile inside the section, (0, 0) when $mask is
+        the mask of the whole section;
+        - tile_core: (width, height) of the tile. Only patches starting in the tile
+        are returned, the others are left to the neighbouring tiles. None means 
+        the whole $mask.
+
+    Returns:
+        - X, Y: int32 arrays, coordinates (x_min, y_min) of valid patches in the section.
+
+        !!! The grids of patches start from the corners of the bounding boxes, 
+        wherever the tiles are, so tiling does not change the patches selected.
+    '''
+
+    tile_x, tile_y = tile_origin
+    mask_height, mask_width = mask.shape[:2]
+
+    if tile_core is None:
+        tile_core = (mask_width, mask_height)
 
     '''
         !!! 
@@ -351,114 +770,105 @@ def construct_bags(wsi_obj, wsi_rgb, contours, mask, level, \
         highly related to the SEGMENTATION results.
 
     '''
-    contours_ = sorted(contours, key = cv2.contourArea, reverse = True)
-    contours_ = contours_[:5]
+    '''
 
-    for i, box_ in enumerate(contours_):
+    !!! Take care of difference in shapes:
 
-        box_ = cv2.boundingRect(np.squeeze(box_))
-        # print('region', i)
-        # 
-        '''
+        Coordinates in bounding boxes: (WIDTH, HEIGHT)
+        WSI image: (HEIGHT, WIDTH, CHANNEL)
+        Mask: (HEIGHT, WIDTH)
 
-        !!! Take care of difference in shapes:
+    '''
+    boxes = np.array(bounding_boxes[:5], dtype=np.int64).reshape(-1, 4)
 
-            Coordinates in bounding boxes: (WIDTH, HEIGHT)
-            WSI image: (HEIGHT, WIDTH, CHANNEL)
-            Mask: (HEIGHT, WIDTH, CHANNEL)
+    # Move the boxes into the tile, and start them on their first grid
+    # point inside the tile.
+    boxes[:, :2] -= (tile_x, tile_y)
 
-        '''
+    for axis_ in (0, 1):
+        skip_ = np.maximum(-boxes[:, axis_], 0)
+        skip_ = (skip_ + patch_size - 1) // patch_size * patch_size
+        boxes[:, axis_] += skip_
+        boxes[:, axis_ + 2] -= skip_
 
-        b_x_start = int(box_[0])
-        b_y_start = int(box_[1])
-        b_x_end = int(box_[0]) + int(box_[2])
-        b_y_end = int(box_[1]) + int(box_[3])
-        
-        '''
-            !!!
-            step size could be tuned for better results, and step size will greatly affect 
-            the number of patches extracted.
-        '''
+    boxes = boxes[(boxes[:, 2] > 0) & (boxes[:, 3] > 0)]
 
-        # step size: PATCH_SIZE / 2 -> PATCH_SIZE
+    '''
+        The valid area of each patch is looked up in the integral image of the
+        binary mask, which costs 4 reads per patch instead of a count over
+        (patch_size * patch_size) pixels.
 
-        X = np.arange(b_x_start, b_x_end, step=patch_size)
-        Y = np.arange(b_y_start, b_y_end, step=patch_size)        
-        
-        # print('ROI length:', len(X), len(Y))
-        
-        for h_pos, y_height_ in enumerate(Y):
-        
-            for w_pos, x_width_ in enumerate(X):
-
-                # Read again from WSI object wastes tooooo much time.
-                # patch_img = wsi_.read_region((x_width_, y_height_), level, (patch_size, patch_size))
-                
-                '''
-                    !!! Take care of difference in shapes
-                    Here, the shape of wsi_rgb is (HEIGHT, WIDTH, CHANNEL)
-                    the shape of mask is (HEIGHT, WIDTH, CHANNEL)
-                '''
-                patch_arr = wsi_rgb[y_height_: y_height_ + patch_size,\
-                                    x_width_:x_width_ + patch_size,:]            
-                # print("read_region (scaled coordinates): ", x_width_, y_height_)
-
-                width_mask = x_width_
-                height_mask = y_height_                
-                
-                patch_mask_arr = mask[height_mask: height_mask + patch_size, \
-                                      width_mask: width_mask + patch_size]
-
-                # print("Numpy mask shape: ", patch_mask_arr.shape)
-                # print("Numpy patch shape: ", patch_arr.shape)
-
-                try:
-                    bitwise_ = cv2.bitwise_and(patch_arr, patch_mask_arr)
-                
-                except Exception as err:
-                    print('Out of the boundary')
-                    pass
-                    
-#                     f_ = ((patch_arr > PIXEL_TH) * 1)
-#                     f_ = (f_ * PIXEL_WHITE).astype('uint8')
-#                     if np.mean(f_) <= (PIXEL_TH + 40):
-#                         patches.append(patch_arr)
-#                         patches_coords.append((x_width_, y_height_))
-#                         print(x_width_, y_height_)
-#                         print('Saved\n')
-
-                else:
-                    bitwise_grey = cv2.cvtColor(bitwise_, cv2.COLOR_RGB2GRAY)
-                    white_pixel_cnt = cv2.countNonZero(bitwise_grey)
-
-                    '''
-                        Patches whose valid area >= 25% of total area is considered
-                        valid and selected.
-                    '''
-
-                    if white_pixel_cnt >= ((patch_size ** 2) * 0.5):
-
-                        if (patch_arr.shape[0], patch_arr.shape[1])  == \
-                        (patch_size, patch_size):
-
-                            patches.append(patch_arr)
-                            patches_coords.append((x_width_ + delta_x , 
-                                                   y_height_ + delta_y))
-                            patches_coords_local.append((x_width_, y_height_))
-
-                            # print("global:", x_width_ + delta_x, y_height_ + delta_y)
-                            # print("local: ", x_width_, y_height_)
-                            # print('Saved\n')
-
-                    else:
-                        pass
-                        # print('Did not save\n')
+        !!!
+        step size could be tuned for better results, and step size will greatly affect 
+        the number of patches extracted. Currently step size is patch_size.
+    '''
+    tile_mask = mask[:tile_core[1] + patch_size - 1, :tile_core[0] + patch_size - 1]
+    mask_integral = cv2.integral((tile_mask > 0).astype(np.uint8))
+
+    # Patches crossing the boundary are dropped.
+    x_limit = min(tile_mask.shape[1] - patch_size + 1, tile_core[0])
+    y_limit = min(tile_mask.shape[0] - patch_size + 1, tile_core[1])
+
+    '''
+        Patches whose valid area >= 50% of total area is considered
+        valid and selected.
+    '''
+    X, Y = collect_positions(mask_integral, boxes, patch_size, \
+                             (patch_size ** 2) * 0.5, x_limit, y_limit)
+
+    return X + tile_x, Y + tile_y
+
+'''
+    Extract patches which are considered valid in the segmentation step. 
+'''
+def construct_bags(wsi_rgb, bounding_boxes, mask, spec, patch_size):
+
+    '''
+    Args:
+        - wsi_rgb: RGB image of the whole section;
+        - bounding_boxes: regions sorted by areas, see get_contours();
+        - mask:
+        - spec: SectionSpec of the section, see section_spec();
+        - patch_size:
+
+    Returns:
+        - patches: patches in numpy array: [NUMBER_OF_PATCHES, PATCH_HEIGHT, PATCH_WIDTH, CHANNEL]
+
+        - patches_coords: coordinates of patches, (x_min, y_min). 
+        The bouding box of the patch is (x_min, y_min, x_min + PATCH_WIDTH, y_min + PATCH_HEIGHT)
+
+        extract_section() does the same tile by tile, without loading the whole section.
+    '''
+
+    patches_coords = list()
+    patches_coords_local = list()
+
+    start = time.time()
+
+    delta_x, delta_y = spec.delta_x, spec.delta_y
+
+    X, Y = patch_positions(bounding_boxes, mask, patch_size)
+
+    # The number of patches is known now, so they are copied into one array
+    # directly, rather than collected in a list and converted afterwards.
+    patches = np.empty((len(X), patch_size, patch_size, CHANNEL), np.uint8)
+
+    for i, (x_width_, y_height_) in enumerate(zip(X, Y)):
+
+        # Read again from WSI object wastes tooooo much time.
+        # patch_img = wsi_.read_region((x_width_, y_height_), level, (patch_size, patch_size))
+
+        patches[i] = wsi_rgb[y_height_: y_height_ + patch_size,\
+                             x_width_:x_width_ + patch_size,:]
+
+        patches_coords.append((int(x_width_) + delta_x, int(y_height_) + delta_y))
+        patches_coords_local.append((int(x_width_), int(y_height_)))
 
     # end = time.time()
     # print("Time spent on patch extraction: ",  (end - start))
 
     # patches_ = [patch_[:,:,:3] for patch_ in patches] 
-    print("Total number of patches extracted: ", len(patches))
+    logger.debug("Total number of patches extracted: %d", len(patches))
     
     return patches, patches_coords, patches_coords_local
 
@@ -516,29 +926,38 @@ def parse_annotation(anno_path, level, mag_factor):
     return polygon_list, anno_list
     
 
+'''
+    Save one patch as JPEG image.
+'''
+def save_jpeg(patch_, patch_name):
+    im = Image.fromarray(patch_)
+    im.save(patch_name)
+
 '''
     Save patches to disk.
 '''
-def save_to_disk(patches, patches_coords, tumor_dict, mask, 
-    slide_, level, current_section):
-    
+def section_dir(slide_, level, current_section):
+
     '''
         The paths should be changed to your own paths.
     '''
     case_name = slide_.split('/')[-1].split('.')[0]
 
-    prefix_dir = './dataset_patches/' + case_name + \
-                 '/level' + str(level) + '/' + current_section + '/'
+    return './dataset_patches/' + case_name + \
+           '/level' + str(level) + '/' + current_section + '/'
+
+def save_to_disk(patches, patches_coords, tumor_dict, mask, 
+    slide_, level, current_section):
+    
+    prefix_dir = section_dir(slide_, level, current_section)
 
-    patch_array_dst = './dataset_patches/' + case_name + \
-                      '/level' + str(level) + '/' + current_section + '/patches/' 
+    patch_array_dst = prefix_dir + 'patches/' 
 
-    patch_coords_dst = './dataset_patches/' + case_name + \
-                       '/level' + str(level) + '/' + current_section + '/'
+    patch_coords_dst = prefix_dir
 
     array_file = patch_array_dst + 'patch_'
     
-    coords_file = patch_coords_dst + 'patch_coords' + current_section + '.csv'
+    coords_file = patch_coords_dst + 'patch_coords' + current_section + '.parquet'
     mask_file = patch_coords_dst + 'mask'
 
     if not os.path.exists(patch_array_dst):
@@ -556,44 +975,48 @@ def save_to_disk(patches, patches_coords, tumor_dict, mask,
     
     '''
         Save coordinates to the disk. Here we use pandas DataFrame to organize 
-        and save coordinates.
+        and save coordinates. Parquet files (which require pyarrow) are binary
+        and columnar, so they are much smaller and faster to write than CSV.
     '''
 
-    df1_ = pd.DataFrame([coord[0] for coord in patches_coords], columns = ["coord_x"])
-    df1_["coord_y"] = [coord[1] for coord in patches_coords]
-    
     if tumor_dict == None:
+        tumor_dict = dict()
 
-        df1_["tumor_area"] = [0 for coord in patches_coords]
-        df1_["tumor_%"] = [0 for coord in patches_coords]
-    
-    else:
-        df1_["tumor_area"] = [tumor_dict[coord] for coord in patches_coords]
-        df1_["tumor_%"] = [tumor_dict[coord] / (PATCH_SIZE * PATCH_SIZE) \
-                       for coord in patches_coords]
+    records_ = [(coord[0], coord[1], tumor_dict.get(coord, 0)) \
+                for coord in patches_coords]
+
+    df1_ = pd.DataFrame.from_records(records_, \
+                                     columns=["coord_x", "coord_y", "tumor_area"])
+    df1_["tumor_%"] = df1_["tumor_area"] / (PATCH_SIZE * PATCH_SIZE)
 
-    df1_.to_csv(coords_file, encoding='utf-8', index=False)
+    df1_.to_parquet(coords_file, index=False)
     
     '''
     Save patch arrays to the disk
     '''
-    # patch_whole = np.array(patches1).shape
+    # Save whole patches as one array.
+    # shape: (NUMBER_OF_PATCHES, PATCH_WIDTH, PATCH_HEIGHT, CHANNEL)
 
-    for i, patch_ in enumerate(patches):
+    patch_whole = prefix_dir + 'patch_whole' + current_section
+
+    # extract_section() already wrote the patches into the file through np.memmap.
+    if isinstance(patches, np.memmap):
+        patches.flush()
+    else:
+        np.save(patch_whole, patches)
+
+    '''
+        Patch images are still saved one by one, as preprocessingAndanalysis() 
+        reads the coordinates from their names. JPEG encoding releases the GIL, 
+        so the images are encoded in parallel threads.
+    '''
+    patch_names = [array_file + str(i) + '_' + str(x_) + '_' + str(y_) + '.jpeg' \
+                   for i, (x_, y_) in enumerate(patches_coords)]
+
+    with ThreadPoolExecutor(max_workers=JPEG_THREADS) as executor:
+        list(executor.map(save_jpeg, patches, patch_names))
 
-        x_, y_ = patches_coords[i]
-        patch_name = array_file + str(i) + '_' + str(x_) + '_' + str(y_)
-        
-        np.save(patch_name, np.array(patch_))
-        im = Image.fromarray(patch_)
-        im.save(patch_name + '.jpeg')
-        
-    # Save whole patches: convert list of patches to array.
-    # shape: (NUMBER_OF_PATCHES, PATCH_WIDTH, PATCH_HEIGHT, CHANNEL)
 
-    # patch_whole = prefix_dir + 'patch_whole' + current_section
-    # np.save(patch_whole, np.array(patches))
-    
     '''
         Save mask file to the disk. Uncomment if mask file is needed.
     '''
@@ -843,35 +1266,73 @@ def calculate_intersection(poly_, start_x, start_y, patch_width=500, patch_heigh
 '''
     Calculate tumor area.
 '''
-def calc_tumorArea(polygon_list, patches_coords):
+def calc_tumorArea(polygon_list, patches_coords, patch_size=PATCH_SIZE):
     '''
+    The annotated tumor areas are rasterized into a mask with cv2.fillPoly, and 
+    the tumor area of a patch is the number of non-zero pixels of the mask in it. 
+    This is much faster than intersecting each patch with shapely Polygons.
+
+    Args:
+        - polygon_list: annotation areas in selected level scale, see parse_annotation().
+        Either the shapely Polygons ($polygon_list) or the lists of (x, y) nodes 
+        ($anno_list) could be passed;
+        - patches_coords: coordinates of patches, (x_min, y_min);
+        - patch_size: size of patches.
+
+    Returns:
+        - area_list: dict, {coords: tumor area of the patch}.
+
+        !!! Only the region covered by both the patches and the annotations is 
+        rasterized, so the mask is at most as large as the section.
     '''
-    patch_size=500
 
-    area_list = dict()
+    area_list = dict((coords, 0) for coords in patches_coords)
 
-    for coords in patches_coords:
-    
-        x_, y_ = coords
-        
-        area_sum = 0
+    polygons = list()
 
-        for idx_, poly_ in enumerate(polygon_list):
+    for area_ in polygon_list:
+        # shapely Polygons are converted to their nodes.
+        if hasattr(area_, 'exterior'):
+            area_ = area_.exterior.coords
 
-            area_, _ = calculate_intersection(poly_, x_, y_)
-            area_sum += area_
-            # print((x_, y_), area_)
+        if len(area_) > 2:
+            polygons.append(np.array(area_, dtype=np.int64).reshape(-1, 2))
 
-        if int(area_sum) > 0:
-            print((x_, y_), "sum:", area_sum / (patch_size * patch_size), area_sum)
+    if not len(polygons) or not len(patches_coords):
+        return area_list
 
-            if area_sum >= patch_size * patch_size:
-                area_sum = patch_size * patch_size
+    coords_arr = np.array(patches_coords, dtype=np.int64).reshape(-1, 2)
+    nodes_arr = np.concatenate(polygons)
 
-            area_list[coords] = int(area_sum)
+    x_min = max(coords_arr[:, 0].min(), nodes_arr[:, 0].min())
+    y_min = max(coords_arr[:, 1].min(), nodes_arr[:, 1].min())
+    x_max = min(coords_arr[:, 0].max() + patch_size, nodes_arr[:, 0].max() + 1)
+    y_max = min(coords_arr[:, 1].max() + patch_size, nodes_arr[:, 1].max() + 1)
 
-        else:
-            area_list[coords] = 0
+    if x_max <= x_min or y_max <= y_min:
+        return area_list
+
+    tumor_mask = np.zeros((y_max - y_min, x_max - x_min), np.uint8)
+
+    # Polygons are filled one by one, so overlapping areas are not cancelled out.
+    for poly_ in polygons:
+        cv2.fillPoly(tumor_mask, [(poly_ - (x_min, y_min)).astype(np.int32)], 1)
+
+    debug_ = logger.isEnabledFor(logging.DEBUG)
+
+    for coords in patches_coords:
+
+        x_ = int(coords[0]) - x_min
+        y_ = int(coords[1]) - y_min
+
+        area_sum = np.count_nonzero(tumor_mask[max(y_, 0): max(y_ + patch_size, 0), \
+                                               max(x_, 0): max(x_ + patch_size, 0)])
+
+        if debug_ and area_sum > 0:
+            logger.debug("%s sum: %f %d", coords, \
+                         area_sum / (patch_size * patch_size), area_sum)
+
+        area_list[coords] = int(area_sum)
 
     return area_list
 
@@ -910,7 +1371,7 @@ def preprocessingAndanalysis(slide_name, section_list, positivethresh, \
             continue
 
         coordinates_file = [i for i in os.listdir(dir_) \
-                            if '.csv' in i][0]
+                            if '.parquet' in i][0]
         coordxml_file = dataset_dir + slide_name + level_dir + sect + '/' + coordinates_file
         # print(patches_dir)
         patches_dir_all.append(patches_dir)
@@ -937,7 +1398,7 @@ def preprocessingAndanalysis(slide_name, section_list, positivethresh, \
     frames = list()
     for coordsfile in coordinates_file_all:
 
-        df_tmp = pd.read_csv(coordsfile)
+        df_tmp = pd.read_parquet(coordsfile)
         frames.append(df_tmp)
     
     # pd_all: DataFrame which holds all the coords
@@ -1081,10 +1542,238 @@ def draw_pospatch(patchpath, slidepath, annopath, level, \
     return patchfilled_img, patchannotated_img
 
 
+'''
+    Extract patches from one section, tile by tile.
+'''
+def extract_section(wsi_obj, level, mag_factor, spec, tile_size=TILE, vips_obj=None, \
+                    patches_file=None):
+    '''
+    Args:
+        - wsi_obj: OpenSlide object;
+        - level: magnification level;
+        - mag_factor: pow(2, level);
+        - spec: SectionSpec, indicates which part of the WSI, see section_spec();
+        - tile_size: size of tiles read from the section;
+        - vips_obj: pyvips image of the level used to read tiles, see read_tile();
+        - patches_file: path of a .npy file. If given, the patches are written into
+        it through np.memmap instead of being held in memory.
+
+    Returns:
+        - patches, patches_coords, patches_coords_local: same to construct_bags(),
+        patches of all the tiles are written into one array (np.memmap if 
+        $patches_file is given);
+        - mask: binary mask of the whole section, downsampled by MASK_DOWNSAMPLE,
+        (ceil(HEIGHT / MASK_DOWNSAMPLE), ceil(WIDTH / MASK_DOWNSAMPLE)).
+
+        !!! The section is processed in two passes over its tiles:
+        1. Each tile is read with a halo of SEG_HALO and segmented, and the 
+        downsampled masks of the tiles are stitched. The regions are found in the 
+        mask of the whole section, so the first 5 regions are those of the section,
+        not of a tile;
+        2. For each tile, the valid patches starting in it are located in its part
+        of the section mask, scaled back to full resolution, and only the part of 
+        the slide covered by them is read again.
+
+        The section mask and its labels are kept downsampled, so they take 
+        1 / MASK_DOWNSAMPLE ** 2 of the memory of a full resolution mask.
+
+        The patches of all tiles are counted before any of them is read, so each
+        tile is copied straight into its place in the output array.
+    '''
+
+    width_split, height_split = spec.w, spec.h
+
+    # Tiles start on the blocks of the downsampled mask.
+    tile_size = max(tile_size // MASK_DOWNSAMPLE, 1) * MASK_DOWNSAMPLE
+
+    positions_tiles = list()
+    patches_coords = list()
+    patches_coords_local = list()
+
+    mask = np.zeros((-(-height_split // MASK_DOWNSAMPLE), \
+                     -(-width_split // MASK_DOWNSAMPLE)), np.uint8)
+
+    tiles = [(tile_x, tile_y, min(tile_size, width_split - tile_x), \
+              min(tile_size, height_split - tile_y)) \
+             for tile_y in range(0, height_split, tile_size) \
+             for tile_x in range(0, width_split, tile_size)]
+
+    for tile_x, tile_y, core_w, core_h in tiles:
+
+        read_x = max(tile_x - SEG_HALO, 0)
+        read_y = max(tile_y - SEG_HALO, 0)
+        read_w = min(tile_x + core_w + SEG_HALO, width_split) - read_x
+        read_h = min(tile_y + core_h + SEG_HALO, height_split) - read_y
+
+        # HSV is computed on a downsampled image in segmentation_mask(),
+        # so only the RGB image is needed here.
+        wsi_rgb_ = read_tile(wsi_obj, level, mag_factor, spec.delta_x + read_x, \
+                             spec.delta_y + read_y, read_w, read_h, vips_obj)
+
+        tile_mask = segmentation_mask(wsi_rgb_, downsampled=True)
+        del wsi_rgb_
+
+        # read_x, read_y, tile_x and tile_y are all multiples of MASK_DOWNSAMPLE.
+        x_small, y_small = tile_x // MASK_DOWNSAMPLE, tile_y // MASK_DOWNSAMPLE
+        w_small = -(-(tile_x + core_w) // MASK_DOWNSAMPLE) - x_small
+        h_small = -(-(tile_y + core_h) // MASK_DOWNSAMPLE) - y_small
+        x_offset = (tile_x - read_x) // MASK_DOWNSAMPLE
+        y_offset = (tile_y - read_y) // MASK_DOWNSAMPLE
+
+        mask[y_small: y_small + h_small, x_small: x_small + w_small] \
+        = tile_mask[y_offset: y_offset + h_small, x_offset: x_offset + w_small]
+        del tile_mask
+
+    bounding_boxes, mask = get_contours(mask)
+
+    # Bounding boxes back to full resolution, clipped to the section.
+    bounding_boxes = bounding_boxes.astype(np.int64) * MASK_DOWNSAMPLE
+    bounding_boxes[:, 2] = np.minimum(bounding_boxes[:, 2], \
+                                      width_split - bounding_boxes[:, 0])
+    bounding_boxes[:, 3] = np.minimum(bounding_boxes[:, 3], \
+                                      height_split - bounding_boxes[:, 1])
+
+    for tile_x, tile_y, core_w, core_h in tiles:
+
+        # No patch could start in tiles that close to the section border. They 
+        # are still segmented above, since the patches before them overlap them.
+        if width_split - tile_x < PATCH_SIZE or height_split - tile_y < PATCH_SIZE:
+            continue
+
+        tile_mask = upsample_mask(mask, tile_x, tile_y, \
+                                  min(core_w + PATCH_SIZE - 1, width_split - tile_x), \
+                                  min(core_h + PATCH_SIZE - 1, height_split - tile_y))
+
+        X, Y = patch_positions(bounding_boxes, tile_mask, PATCH_SIZE, \
+                               tile_origin=(tile_x, tile_y), \
+                               tile_core=(core_w, core_h))
+        del tile_mask
+
+        if len(X):
+            positions_tiles.append((X, Y))
+
+    patches_num = sum(len(X) for X, _ in positions_tiles)
+
+    if patches_file is not None and patches_num:
+        if not os.path.exists(os.path.dirname(patches_file)):
+            os.makedirs(os.path.dirname(patches_file))
+
+        patches = np.lib.format.open_memmap(patches_file, mode='w+', dtype=np.uint8, \
+                                            shape=(patches_num, PATCH_SIZE, \
+                                                   PATCH_SIZE, CHANNEL))
+    else:
+        patches = np.empty((patches_num, PATCH_SIZE, PATCH_SIZE, CHANNEL), np.uint8)
+
+    k = 0
+
+    for X, Y in positions_tiles:
+
+        read_x, read_y = int(X.min()), int(Y.min())
+        read_w = int(X.max()) + PATCH_SIZE - read_x
+        read_h = int(Y.max()) + PATCH_SIZE - read_y
+
+        wsi_rgb_ = read_tile(wsi_obj, level, mag_factor, spec.delta_x + read_x, \
+                             spec.delta_y + read_y, read_w, read_h, vips_obj)
+
+        for x_width_, y_height_ in zip(X - read_x, Y - read_y):
+            patches[k] = wsi_rgb_[y_height_: y_height_ + PATCH_SIZE, \
+                                  x_width_: x_width_ + PATCH_SIZE, :]
+            k += 1
+
+        patches_coords += [(int(x_) + spec.delta_x, int(y_) + spec.delta_y) \
+                           for x_, y_ in zip(X, Y)]
+        patches_coords_local += [(int(x_), int(y_)) for x_, y_ in zip(X, Y)]
+
+        del wsi_rgb_
+
+    del positions_tiles
+
+    print("Total number of patches extracted in section", spec.sect, ":", len(patches))
+
+    return patches, patches_coords, patches_coords_local, mask
+
+'''
+    Limit the threads of one multiprocessing.Pool worker.
+'''
+def init_worker(threads):
+    '''
+        OpenCV, numba (collect_positions) and the JPEG encoding of save_to_disk()
+        would each start about one thread per CPU in every worker. As the 
+        sections already run in parallel processes, each worker is given 
+        $threads threads only.
+    '''
+    global JPEG_THREADS
+
+    cv2.setNumThreads(threads)
+    JPEG_THREADS = threads
+
+    try:
+        import numba
+        numba.set_num_threads(threads)
+    except (ImportError, AttributeError):
+        # numba is not installed, or too old to set it.
+        pass
+
+'''
+    Process one section of the WSI. 
+'''
+def process_section(args):
+    '''
+    This func is designed to be run by multiprocessing.Pool workers, as the 
+    sections are independent of each other.
+
+    Args:
+        - args: tuple of (slide_path, anno_list, level, mag_factor, spec), where
+        spec is the SectionSpec of the section.
+        anno_list is None if the slide is not annotated.
+
+    Returns: 
+        - number of patches extracted from the section.
+
+        !!! OpenSlide objects could not be safely shared among processes, so 
+        the slide is opened again in each worker. The pyvips image, if any, is 
+        opened once per worker and reused for its following sections.
+    '''
+
+    slide_path, anno_list, level, mag_factor, spec = args
+
+    start = time.time()
+
+    wsi_obj = openSlide_init(slide_path, level)
+
+    patches, patches_coords, patches_coords_local, mask \
+    = extract_section(wsi_obj, level, mag_factor, spec, \
+                      vips_obj=vips_init(slide_path, level), \
+                      patches_file=section_dir(slide_path, level, spec.sect) \
+                                   + 'patch_whole' + spec.sect + '.npy')
+
+    if anno_list is not None:
+        tumor_dict = calc_tumorArea(anno_list, patches_coords)
+    else:
+        tumor_dict = None
+
+    # Sections without patches are saved too (empty arrays), so no files of 
+    # an earlier run are left behind.
+    save_to_disk(patches, patches_coords, tumor_dict, mask, \
+                 slide_path, level, spec.sect)
+
+    patches_num = len(patches)
+
+    del patches
+    del mask
+    release_memory()
+
+    wsi_obj.close()
+
+    end = time.time()
+    print("Time spent on section", spec.sect,  (end - start), '\n')
+
+    return patches_num
+
 '''
     The whole pipeline of extracting patches.
 '''
-def extract_all(slide_path, anno_path, level, mag_factor, pnflag=True):
+def extract_all(slide_path, anno_path, level, mag_factor, pnflag=True, processes=None):
     '''
     Args:
         slide_path: Path to target slide, 
@@ -1098,9 +1787,16 @@ def extract_all(slide_path, anno_path, level, mag_factor, pnflag=True):
         mag_factor: Pow(2, level);
         
         pnflag: Boolean, which indicates whether it is a positive one or not
+
+        processes: number of sections processed at the same time, the number of
+        CPUs if None. Lower it if the RAM could not hold that many sections.
     
     Returns: 
-        To-do.
+        - patches_all: list of numbers of patches extracted from each section.
+
+        !!! The sections are processed in parallel, one process per section, and 
+        patches are saved to the disk by the workers. The CPUs are shared among 
+        the workers, see init_worker().
     '''
     
     section_list = ['00', '01', '02', '03', \
@@ -1108,60 +1804,31 @@ def extract_all(slide_path, anno_path, level, mag_factor, pnflag=True):
                     '20', '21', '22', '23', \
                     '30', '31', '32', '33']
 
-    patches_all = list()
-
-    wsi_obj=openSlide_init(slide_path, level)
+    anno_list = None
 
     if pnflag:
-        polygon_list, anno_list = parse_annotation(anno_path, level, mag_factor)
-
-    time_all = 0
+        _, anno_list = parse_annotation(anno_path, level, mag_factor)
 
-    for sect in section_list:
-        
-        start = time.time()
+    start = time.time()
 
-        rgba_image = read_wsi(wsi_obj, level, mag_factor, sect)
-        wsi_rgb_, wsi_gray_, wsi_hsv_ = construct_colored_wsi(rgba_image)
-        # print('Transformed shape: (height, width, channel)')
-        # print("WSI HSV shape: ", wsi_hsv_.shape)
-        # print("WSI RGB shape: ", wsi_rgb_.shape)
-        # print("WSI GRAY shape: ", wsi_gray_.shape)
-        # print('\n')
+    # Sections are computed once here and passed to the workers.
+    wsi_obj = openSlide_init(slide_path, level)
+    args_list = [(slide_path, anno_list, level, mag_factor, \
+                  section_spec(wsi_obj, level, sect)) for sect in section_list]
+    wsi_obj.close()
 
-        del rgba_image
-        gc.collect()
+    if processes is None:
+        processes = os.cpu_count()
 
-        bounding_boxes, contour_coords, contours, mask \
-        = segmentation_hsv(wsi_hsv_, wsi_rgb_)
+    processes = max(min(processes, len(section_list)), 1)
+    threads = max(os.cpu_count() // processes, 1)
 
-        del wsi_hsv_
-        gc.collect()
+    with multiprocessing.Pool(processes, initializer=init_worker, \
+                              initargs=(threads,)) as pool:
+        patches_all = pool.map(process_section, args_list)
 
-        patches, patches_coords, patches_coords_local\
-        = construct_bags(wsi_obj, wsi_rgb_, contours, mask, \
-                        level, mag_factor, PATCH_SIZE, sect)
-        
-        if len(patches):
-            patches_all.append(patches)
-            if pnflag:
-                tumor_dict = calc_tumorArea(polygon_list, patches_coords)
-            else:
-                tumor_dict = None
-
-            save_to_disk(patches, patches_coords, tumor_dict, mask, \
-                         slide_path, level, sect)
-
-        del wsi_rgb_
-        del patches
-        del mask
-        gc.collect()
-        
-        end = time.time()
-        time_all += end - start
-        print("Time spent on section", sect,  (end - start), '\n')
-    
-    print('total time: ', time_all)    
+    end = time.time()
+    print('total time: ', (end - start))
     
     return patches_all
 
@@ -1193,7 +1860,7 @@ def extract_all_Plus(slide_path, anno_path, section_list, pnflag=True, level=1):
         '''
             if this slide is an annotated positive slide.
         '''
-        polygon_list, anno_list = parse_annotation(anno_path, level, mag_factor)
+        _, anno_list = parse_annotation(anno_path, level, mag_factor)
 
     time_all = 0
 
@@ -1203,37 +1870,26 @@ def extract_all_Plus(slide_path, anno_path, section_list, pnflag=True, level=1):
 
         start = time.time()
 
-        rgba_image = read_wsi(wsi_obj, level, mag_factor, sect)
-        wsi_rgb_, wsi_gray_, wsi_hsv_ = construct_colored_wsi(rgba_image)
-
-        del rgba_image
-        gc.collect()
-
-        bounding_boxes, contour_coords, contours, mask \
-        = segmentation_hsv(wsi_hsv_, wsi_rgb_)
-
-        del wsi_hsv_
-        del wsi_gray_
-        gc.collect()
-
-        patches, patches_coords, patches_coords_local\
-        = construct_bags(wsi_obj, wsi_rgb_, contours, mask, \
-                        level, mag_factor, sect, PATCH_SIZE, SPLIT)
+        patches, patches_coords, patches_coords_local, mask \
+        = extract_section(wsi_obj, level, mag_factor, \
+                          section_spec(wsi_obj, level, sect), \
+                          vips_obj=vips_init(slide_path, level))
 
         if len(patches):
             patches_all.append(patches)
-            if pnflag:
-                tumor_dict = calc_tumorArea(polygon_list, patches_coords)
-            else:
-                tumor_dict = None
 
-            save_to_disk(patches, patches_coords, tumor_dict, mask, \
-                         slide_path, level, sect)
+        if pnflag:
+            tumor_dict = calc_tumorArea(anno_list, patches_coords)
+        else:
+            tumor_dict = None
+
+        # Sections without patches are saved too, see process_section().
+        save_to_disk(patches, patches_coords, tumor_dict, mask, \
+                     slide_path, level, sect)
 
-        del wsi_rgb_
         del patches
         del mask
-        gc.collect()
+        release_memory()
 
         end = time.time()
         time_all += end - start
@@ -1317,27 +1973,23 @@ def capextract(slide_name, dataset_dir='./dataset_patches/', level_dir='/level1/
         img_sample_, wsi_img = extract_all_Plus(slide_path, anno_path, section_list0, pnflag, level=1)
         del img_sample_
         del wsi_img
-        gc.collect()
         
         section_list1 = ['10', '11', '12', '13']
         img_sample_, wsi_img = extract_all_Plus(slide_path, anno_path, section_list1, pnflag, level=1)
         del img_sample_
         del wsi_img
-        gc.collect()
 
         print('sec list 2\n\n')
         section_list2 = ['20', '21', '22', '23']
         img_sample_, wsi_img = extract_all_Plus(slide_path, anno_path, section_list2, pnflag, level=1)
         del img_sample_
         del wsi_img
-        gc.collect()
 
         print('sec list 3\n\n')    
         section_list3 = ['30', '31', '32', '33']
         img_sample_, wsi_img = extract_all_Plus(slide_path, anno_path, section_list3, pnflag, level=1)
         del img_sample_
         del wsi_img
-        gc.collect()  
 
     except:
         print("???:", slide_name)
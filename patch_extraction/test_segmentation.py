@@ -0,0 +1,39 @@
+'''
+    Tests of the segmentation in extract_patches_split.py.
+
+    Run with: python -m unittest discover patch_extraction
+'''
+import unittest
+
+import numpy as np
+
+try:
+    import extract_patches_split as eps
+except ImportError:
+    # OpenSlide / shapely etc. are not installed.
+    eps = None
+
+
+@unittest.skipIf(eps is None, 'dependencies of extract_patches_split are missing')
+class SegmentationMaskTest(unittest.TestCase):
+
+    def test_kernel_sizes_are_odd(self):
+        for full_size in (1, 5, 15, 31):
+            size_ = eps.morph_size(full_size)
+            self.assertEqual(size_ % 2, 1)
+            self.assertGreaterEqual(size_, 3)
+
+    def test_centred_square_keeps_its_position(self):
+        # Tissue colour passes the HSV thresholds, the background does not.
+        wsi_rgb_ = np.full((200, 200, 3), 240, np.uint8)
+        wsi_rgb_[80:120, 80:120] = (180, 90, 150)
+
+        mask = eps.segmentation_mask(wsi_rgb_)
+        ys_, xs_ = np.nonzero(mask)
+
+        self.assertEqual((ys_.min(), ys_.max()), (80, 119))
+        self.assertEqual((xs_.min(), xs_.max()), (80, 119))
+
+
+if __name__ == '__main__':
+    unittest.main()
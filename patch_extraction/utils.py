@@ -301,7 +301,7 @@ def calc_tumorArea(polygon_list, patches_coords):
     |   |   |
     |   |   |-- 01
     |   |   |    |--  mask.npy
-    |   |   |    |--  patch_coords01.csv  
+    |   |   |    |--  patch_coords01.parquet
     |   |   |    |--  patch_whole01.npy 
     |   |   |    \--  patches 
     |   |   |         |-- (all the patches)   
@@ -345,7 +345,7 @@ def preprocessingAndanalysis(slide_name, section_list, positivethresh, \
             continue
 
         coordinates_file = [i for i in os.listdir(dir_) \
-                            if '.csv' in i][0]
+                            if '.parquet' in i][0]
         coordxml_file = dataset_dir + slide_name + level_dir + sect + '/' + coordinates_file
         # print(patches_dir)
         patches_dir_all.append(patches_dir)
@@ -372,7 +372,7 @@ def preprocessingAndanalysis(slide_name, section_list, positivethresh, \
     frames = list()
     for coordsfile in coordinates_file_all:
 
-        df_tmp = pd.read_csv(coordsfile)
+        df_tmp = pd.read_parquet(coordsfile)
         frames.append(df_tmp)
     
     # pd_all: DataFrame which holds all the coords